@@ -0,0 +1,85 @@
+#
+# Copyright 2025 Benjamin Kiessling
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+"""
+pangoline.alto
+~~~~~~~~~~~~~~
+"""
+import html
+import numpy as np
+
+from typing import Optional, Sequence
+
+_alto_footer = b"""              </TextBlock>
+            </PrintSpace>
+        </Page>
+    </Layout>
+</alto>
+"""
+
+
+def dump(fo,
+         pdf_path: str,
+         language: str,
+         base_dir: Optional[str],
+         text_block_id: str,
+         page_width: int,
+         page_height: int,
+         line_ids: Sequence[str],
+         line_texts: Sequence[str],
+         line_boxes: np.ndarray,
+         page_number: int = 0):
+    """
+    Writes an ALTO file for a single page of rendered text.
+
+    Args:
+        fo: File object opened in binary mode.
+        pdf_path: Name of the PDF file the page has been rendered to.
+        language: Language tag of the page.
+        base_dir: Base direction of the text block (`ltr` or `rtl`).
+        text_block_id: ID of the single text block on the page.
+        page_width: Width of the page in mm.
+        page_height: Height of the page in mm.
+        line_ids: ID of each line.
+        line_texts: Text of each line.
+        line_boxes: Integer array of shape `(len(line_ids), 5)` with the
+                    `left`, `top`, `right`, `bottom`, and baseline
+                    coordinates of each line in mm.
+        page_number: Index of the page in the PDF file.
+    """
+    dir_attr = f' BASE_DIRECTION="{base_dir}"' if base_dir else ''
+    fo.write(f"""<?xml version="1.0" encoding="UTF-8"?>
+<alto xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    xmlns="http://www.loc.gov/standards/alto/ns-v4#"
+    xsi:schemaLocation="http://www.loc.gov/standards/alto/ns-v4# http://www.loc.gov/standards/alto/v4/alto-4-3.xsd">
+    <Description>
+        <MeasurementUnit>mm</MeasurementUnit>
+        <sourceImageInformation>
+            <fileName>{html.escape(pdf_path)}</fileName>
+        </sourceImageInformation>
+    </Description>
+    <Layout>
+        <Page WIDTH="{page_width}" HEIGHT="{page_height}" PHYSICAL_IMG_NR="{page_number}" ID="page_{page_number}" LANG="{language}">
+            <PrintSpace HPOS="0" VPOS="0" WIDTH="{page_width}" HEIGHT="{page_height}">
+              <TextBlock ID="{text_block_id}"{dir_attr}>
+""".encode('utf-8'))
+    for line_id, line_text, (left, top, right, bottom, bl) in zip(line_ids, line_texts, line_boxes.tolist()):
+        fo.write(f"""                <TextLine ID="{line_id}" HPOS="{left}" VPOS="{top}" WIDTH="{right - left}" HEIGHT="{bottom - top}" BASELINE="{left},{bl} {right},{bl}">
+                  <Shape>
+                    <Polygon POINTS="{left},{top} {right},{top} {right},{bottom} {left},{bottom}"/>
+                  </Shape>
+                  <String CONTENT="{html.escape(line_text)}"/>
+                </TextLine>
+""".encode('utf-8'))
+    fo.write(_alto_footer)
@@ -24,7 +24,8 @@ import logging
 from pathlib import Path
 from rich.progress import Progress
 from multiprocessing import Pool
-from functools import partial
+from multiprocessing.pool import ThreadPool
+from collections import deque
 from itertools import zip_longest
 
 from pangoline.render import _markup_colors
@@ -58,34 +59,94 @@ def _validate_manifests(ctx, param, value):
     return images
 
 
+def _chunksize(num_tasks: int, workers: int) -> int:
+    """
+    Number of tasks to dispatch to a worker at once. Bounded to keep the
+    progress bar responsive.
+    """
+    return min(16, max(1, num_tasks // (workers * 4)))
+
+
+def _maxtasksperchild(maxtasksperchild: int, chunksize: int) -> int:
+    """
+    Converts the number of documents a worker handles before it is replaced
+    into the number of pool tasks, each of them a chunk of documents.
+    """
+    return max(1, maxtasksperchild // chunksize)
+
+
+def _map_chunk(func, chunk):
+    for item in chunk:
+        func(item)
+    return len(chunk)
+
+
+def _imap_bounded(pool, func, items, chunksize: int, buffersize: int):
+    """
+    Applies `func` to `items` in chunks on a pool while keeping at most
+    `buffersize` chunks in flight, instead of queueing all tasks at once like
+    `Pool.imap_unordered`.
+
+    Chunks are strided over `items`, so when items are sorted by descending
+    cost each chunk starts with one of the most expensive items and these
+    are spread across workers instead of ending up in a single chunk.
+
+    Yields:
+        The number of items processed for each finished chunk.
+    """
+    num_chunks = -(-len(items) // chunksize)
+    pending = deque()
+    for idx in range(num_chunks):
+        if len(pending) >= buffersize:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(_map_chunk, (func, items[idx::num_chunks])))
+    while pending:
+        yield pending.popleft().get()
+
+
 @click.group(chain=False)
 @click.version_option()
-@click.option('--workers', show_default=True, default=1, type=click.IntRange(1), help='Number of worker processes.')
-def cli(workers):
+@click.option('--workers', show_default=True, default=1, type=click.IntRange(1), help='Number of worker processes (or threads for `rasterize --threads`).')
+@click.option('--maxtasksperchild', show_default=True, default=64, type=click.IntRange(1),
+              help='Number of documents a worker process handles before it is '
+              'replaced. Lower values bound the memory held by font caches '
+              'and rendering buffers at the cost of more frequent process '
+              'startup.')
+def cli(workers, maxtasksperchild):
     """
     Base command for the text renderer
     """
     ctx = click.get_current_context()
     ctx.meta['workers'] = workers
+    ctx.meta['maxtasksperchild'] = maxtasksperchild
+
+
+# read-only per-run configuration, set once in each worker by the pool
+# initializer so tasks only need to carry the document path.
+_worker_config = {}
+
 
+def _init_worker(config):
+    global _worker_config
+    _worker_config = config
 
-def _render_doc(doc, output_dir, paper_size, margins, font, language,
-                base_dir, enable_markup, random_markup,
-                random_markup_probability, skip_unrenderable):
+
+def _render_doc(doc):
     from pangoline.render import render_text
 
     with open(doc, 'r') as fp:
         render_text(text=fp.read(),
-                    output_base_path=output_dir / doc.name,
-                    paper_size=paper_size,
-                    margins=margins,
-                    font=font,
-                    language=language,
-                    base_dir=base_dir,
-                    enable_markup=enable_markup,
-                    random_markup=random_markup,
-                    random_markup_probability=random_markup_probability,
-                    raise_unrenderable=not skip_unrenderable)
+                    output_base_path=_worker_config['output_dir'] / doc.name,
+                    paper_size=_worker_config['paper_size'],
+                    margins=_worker_config['margins'],
+                    font=_worker_config['font'],
+                    language=_worker_config['language'],
+                    base_dir=_worker_config['base_dir'],
+                    enable_markup=_worker_config['enable_markup'],
+                    random_markup=_worker_config['random_markup'],
+                    random_markup_probability=_worker_config['random_markup_probability'],
+                    raise_unrenderable=not _worker_config['skip_unrenderable'],
+                    single_pdf=_worker_config['single_pdf'])
 
 
 @cli.command('render')
@@ -139,6 +200,11 @@ def _render_doc(doc, output_dir, paper_size, margins, font, language,
 @click.option('--skip-unrenderable/--ignore-unrenderable',
               default=True,
               help='Skips rendering if the text contains unrenderable glyphs.')
+@click.option('--single-pdf/--split-pdf',
+              default=False,
+              show_default=True,
+              help='Renders all pages of a document into a single PDF file '
+              'instead of one PDF file per page.')
 @click.argument('docs',
                 type=click.Path(exists=True, dir_okay=False, readable=True, path_type=Path),
                 nargs=-1)
@@ -153,40 +219,66 @@ def render(ctx,
            random_markup: list[str],
            random_markup_probability: float,
            skip_unrenderable: bool,
+           single_pdf: bool,
            docs):
     """
     Renders text files into PDF documents and creates parallel ALTO facsimiles.
     """
     output_dir.mkdir(exist_ok=True)
 
-    with Pool(ctx.meta['workers'], maxtasksperchild=1000) as pool, Progress() as progress:
+    # dispatch the largest (slowest) documents first to shorten the tail
+    # where only a few workers are still busy.
+    docs = sorted(docs, key=lambda doc: doc.stat().st_size, reverse=True)
+
+    config = {'output_dir': output_dir,
+              'paper_size': paper_size,
+              'margins': margins,
+              'font': font,
+              'language': language,
+              'base_dir': base_dir,
+              'enable_markup': markup,
+              'random_markup': random_markup,
+              'random_markup_probability': random_markup_probability,
+              'skip_unrenderable': skip_unrenderable,
+              'single_pdf': single_pdf}
+
+    chunksize = _chunksize(len(docs), ctx.meta['workers'])
+    with Pool(ctx.meta['workers'],
+              maxtasksperchild=_maxtasksperchild(ctx.meta['maxtasksperchild'], chunksize),
+              initializer=_init_worker,
+              initargs=(config,)) as pool, Progress() as progress:
         render_task = progress.add_task('Rendering', total=len(docs), visible=True)
-        for _ in pool.imap_unordered(partial(_render_doc,
-                                             output_dir=output_dir,
-                                             paper_size=paper_size,
-                                             margins=margins,
-                                             font=font,
-                                             language=language,
-                                             base_dir=base_dir,
-                                             enable_markup=markup,
-                                             random_markup=random_markup,
-                                             random_markup_probability=random_markup_probability,
-                                             skip_unrenderable=skip_unrenderable), docs):
-            progress.update(render_task, total=len(docs), advance=1)
-
-
-def _rasterize_doc(inp, output_base_path, dpi):
+        for num_done in _imap_bounded(pool,
+                                      _render_doc,
+                                      docs,
+                                      chunksize=chunksize,
+                                      buffersize=4 * ctx.meta['workers']):
+            progress.update(render_task, total=len(docs), advance=num_done)
+
+
+def _rasterize_doc(inp):
     from pangoline.rasterize import rasterize_document
     rasterize_document(doc=inp[0],
-                       output_base_path=output_base_path,
+                       output_base_path=_worker_config['output_dir'],
                        writing_surface=inp[1],
-                       dpi=dpi)
+                       dpi=_worker_config['dpi'],
+                       compress_level=_worker_config['compress_level'])
 
 
 @cli.command('rasterize')
 @click.pass_context
 @click.option('-d', '--dpi', default=300, show_default=True,
               help='Resolution for PDF rasterization.')
+@click.option('--png-compress-level', default=1, show_default=True,
+              type=click.IntRange(0, 9),
+              help='zlib compression level of output images. Higher values '
+              'produce smaller files but are considerably slower to encode.')
+@click.option('--threads/--processes', default=False, show_default=True,
+              help='Rasterize with a pool of worker threads or worker '
+              'processes. Threads share a single process and use '
+              'considerably less memory but PDF rendering is serialized '
+              'as pdfium is not thread-safe, so only PNG encoding and '
+              'compositing run in parallel.')
 @click.option('-O', '--output-dir',
               type=click.Path(exists=False,
                               dir_okay=True,
@@ -213,6 +305,8 @@ def _rasterize_doc(inp, output_base_path, dpi):
                 nargs=-1)
 def rasterize(ctx,
               dpi: int,
+              png_compress_level: int,
+              threads: bool,
               output_dir: 'PathLike',
               writing_surface,
               surface_files,
@@ -230,13 +324,34 @@ def rasterize(ctx,
     if surface_files:
         writing_surface.extend(surface_files)
 
+    docs = sorted(docs, key=lambda doc: doc.stat().st_size, reverse=True)
+
     if writing_surface:
         from random import choices
         writing_surface = choices(writing_surface, k=len(docs))
 
     docs = list(zip_longest(docs, writing_surface))
 
-    with Pool(ctx.meta['workers'], maxtasksperchild=1000) as pool, Progress() as progress:
+    config = {'output_dir': output_dir,
+              'dpi': dpi,
+              'compress_level': png_compress_level}
+
+    chunksize = _chunksize(len(docs), ctx.meta['workers'])
+    if threads:
+        pool = ThreadPool(ctx.meta['workers'],
+                          initializer=_init_worker,
+                          initargs=(config,))
+    else:
+        pool = Pool(ctx.meta['workers'],
+                    maxtasksperchild=_maxtasksperchild(ctx.meta['maxtasksperchild'], chunksize),
+                    initializer=_init_worker,
+                    initargs=(config,))
+
+    with pool, Progress() as progress:
         rasterize_task = progress.add_task('Rasterizing', total=len(docs), visible=True)
-        for _ in pool.imap_unordered(partial(_rasterize_doc, output_base_path=output_dir, dpi=dpi), docs):
-            progress.update(rasterize_task, total=len(docs), advance=1)
+        for num_done in _imap_bounded(pool,
+                                      _rasterize_doc,
+                                      docs,
+                                      chunksize=chunksize,
+                                      buffersize=4 * ctx.meta['workers']):
+            progress.update(rasterize_task, total=len(docs), advance=num_done)
@@ -16,20 +16,40 @@
 pangoline.rasterize
 ~~~~~~~~~~~~~~~~~~~
 """
+import io
 import re
+import threading
+import numpy as np
 import pypdfium2 as pdfium
 
 from PIL import Image
 from lxml import etree
 from pathlib import Path
+from collections import OrderedDict
 from typing import Union, Optional, TYPE_CHECKING
 
 if TYPE_CHECKING:
     from os import PathLike
 
 
-@staticmethod
-def _parse_alto_pointstype(coords: str) -> list[tuple[float, float]]:
+# pdfium is not thread-safe, even across separate documents.
+_pdfium_lock = threading.Lock()
+
+# ALTO files up to this size are read into memory with a single read instead
+# of being streamed from disk by the parser.
+_alto_read_limit = 16 * 1024 * 1024
+
+# documents rendered with `single_pdf` reference the same multi-page PDF from
+# each page's ALTO file, so a few recently used documents are kept open
+# instead of parsing the whole PDF again for every page. Maps `(path, mtime,
+# size)` to `[document, number of users]` and is guarded by `_pdfium_lock`.
+_pdf_cache_size = 4
+_pdf_cache = OrderedDict()
+
+_float_re = re.compile(r'[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?')
+
+
+def _parse_alto_pointstype(coords: str) -> list[float]:
     """
     ALTO's PointsType is underspecified so a variety of serializations are valid:
 
@@ -39,25 +59,127 @@ def _parse_alto_pointstype(coords: str) -> list[tuple[float, float]]:
         (x0 y0) (x1 y1) ...
 
     Returns:
-        A list of tuples [(x0, y0), (x1, y1), ...]
+        A flat list of coordinates [x0, y0, x1, y1, ...]
     """
-    float_re = re.compile(r'[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?')
-    points = [float(point.group()) for point in float_re.finditer(coords)]
+    # fast path for the common serializations, falls back to scanning for
+    # anything that looks like a float.
+    try:
+        points = [float(v) for tok in coords.replace('(', ' ').replace(')', ' ').split() for v in tok.split(',') if v]
+    except ValueError:
+        points = [float(point.group()) for point in _float_re.finditer(coords)]
     if len(points) % 2:
         raise ValueError(f'Odd number of points in points sequence: {points}')
     return points
 
 
+def _mm_to_pixels(coords: np.ndarray, dpi: int) -> np.ndarray:
+    """
+    Converts an array of coordinates in mm to integer pixel coordinates at
+    `dpi`. Integral inputs, such as the ones written by `render_text`, are
+    scaled in exact integer arithmetic.
+    """
+    if float(dpi).is_integer() and (coords == np.trunc(coords)).all():
+        # truncate towards zero like the float path instead of flooring
+        scaled = coords.astype(np.int64) * (int(dpi) * 10)
+        return np.sign(scaled) * (np.abs(scaled) // 254)
+    return (coords * (dpi / 25.4)).astype(np.int64)
+
+
+def _acquire_pdf(pdf_file: Path) -> tuple[tuple, pdfium.PdfDocument]:
+    """
+    Returns an open document for `pdf_file` from the document cache, opening
+    it if necessary. Must be called with `_pdfium_lock` held and each call
+    paired with `_release_pdf`.
+
+    Returns:
+        The cache key and the document.
+    """
+    pdf_file = Path(pdf_file).resolve()
+    stat = pdf_file.stat()
+    key = (pdf_file, stat.st_mtime_ns, stat.st_size)
+    if (entry := _pdf_cache.get(key)) is not None:
+        _pdf_cache.move_to_end(key)
+        entry[1] += 1
+        return key, entry[0]
+    pdf = pdfium.PdfDocument(pdf_file)
+    _pdf_cache[key] = [pdf, 1]
+    # evict the least recently used documents not in use by another thread
+    unused = [k for k, (_, users) in _pdf_cache.items() if not users]
+    for old_key in unused[:max(0, len(_pdf_cache) - _pdf_cache_size)]:
+        _pdf_cache.pop(old_key)[0].close()
+    return key, pdf
+
+
+def _release_pdf(key: tuple):
+    """
+    Marks a document acquired with `_acquire_pdf` as unused. Must be called
+    with `_pdfium_lock` held.
+    """
+    _pdf_cache[key][1] -= 1
+
+
+def _rasterize_page(pdf_file: Path,
+                    page_nr: int,
+                    output_path: Path,
+                    writing_surface: Optional[Image.Image],
+                    dpi: int,
+                    compress_level: int) -> tuple[int, int]:
+    """
+    Rasterizes a page of a PDF file, optionally pastes it onto a writing
+    surface, and writes the result as a PNG file.
+
+    Returns:
+        The `(width, height)` of the written image.
+    """
+    _dpi_point = 1 / 72
+
+    transparency = 0 if writing_surface else 255
+    pdf_page = bitmap = None
+    with _pdfium_lock:
+        pdf_key, pdf = _acquire_pdf(pdf_file)
+    try:
+        # render in RGB(A) byte order so the bitmap buffer can be wrapped
+        # by PIL without swizzling channels into a new buffer.
+        with _pdfium_lock:
+            pdf_page = pdf.get_page(page_nr if len(pdf) > 1 else 0)
+            bitmap = pdf_page.render(scale=dpi*_dpi_point,
+                                     fill_color=(255, 255, 255, transparency),
+                                     rev_byteorder=True)
+        im = bitmap.to_pil()
+        if writing_surface:
+            writing_surface = writing_surface.resize(im.size)
+            writing_surface.alpha_composite(im)
+            im = writing_surface
+        im.save(output_path, format='png', compress_level=compress_level)
+        return im.size
+    finally:
+        # the image might share the pdfium-owned buffer, so drop it
+        # before releasing the bitmap.
+        im = None
+        # release explicitly instead of leaving it to finalizers
+        # which might run outside the lock.
+        with _pdfium_lock:
+            if bitmap is not None:
+                bitmap.close()
+            if pdf_page is not None:
+                pdf_page.close()
+            _release_pdf(pdf_key)
+
+
 def rasterize_document(doc: Union[str, 'PathLike'],
                        output_base_path: Union[str, 'PathLike'],
                        writing_surface: Optional[Union[str, 'PathLike']] = None,
-                       dpi: int = 300):
+                       dpi: int = 300,
+                       compress_level: int = 1):
     """
     Takes an ALTO XML file, rasterizes the associated PDF document with the
     given resolution and rewrites the ALTO, translating the physical dimension
     to pixel positions.
 
-    The output image and XML files will be at `output_base_path/doc`.
+    The output image and XML files will be at `output_base_path/doc`. If the
+    PDF document contains multiple pages, e.g. when rendered with
+    `single_pdf`, the page given in the `PHYSICAL_IMG_NR` attribute of the
+    ALTO page is rasterized.
 
     Args:
         doc: Input ALTO file
@@ -68,6 +190,9 @@ def rasterize_document(doc: Union[str, 'PathLike'],
                           The image will be resized to the selected PDF
                           resolution.
         dpi: DPI to render the PDF
+        compress_level: zlib compression level of the output PNG. Higher
+                        values result in smaller files at a considerable
+                        increase in encoding time.
 
     """
     output_base_path = Path(output_base_path)
@@ -76,45 +201,75 @@ def rasterize_document(doc: Union[str, 'PathLike'],
     if writing_surface:
         writing_surface = Image.open(writing_surface).convert('RGBA')
 
-    coord_scale = dpi / 25.4
-    _dpi_point = 1 / 72
+    if doc.stat().st_size <= _alto_read_limit:
+        source = io.BytesIO(doc.read_bytes())
+    else:
+        source = str(doc)
 
-    tree = etree.parse(doc)
-    tree.find('.//{*}MeasurementUnit').text = 'pixel'
-    fileName = tree.find('.//{*}fileName')
-    pdf_file = doc.parent / fileName.text
-    # rasterize and save as png
-    pdf_page = pdfium.PdfDocument(pdf_file).get_page(0)
-    transparency = 0 if writing_surface else 255
-    im = pdf_page.render(scale=dpi*_dpi_point, fill_color=(255, 255, 255, transparency)).to_pil()
-    if writing_surface:
-        writing_surface = writing_surface.resize(im.size)
-        writing_surface.alpha_composite(im)
-        im = writing_surface
-
-    fileName.text = doc.with_suffix('.png').name
-
-    im.save(output_base_path / fileName.text, format='png', optimize=True)
-
-    # rewrite coordinates
-    page = tree.find('.//{*}Page')
-    printspace = page.find('./{*}PrintSpace')
-    page.set('WIDTH', str(im.width))
-    page.set('HEIGHT', str(im.height))
-    printspace.set('WIDTH', str(im.width))
-    printspace.set('HEIGHT', str(im.height))
-
-    for line in tree.findall('.//{*}TextLine'):
-        hpos = int(float(line.get('HPOS')) * coord_scale)
-        vpos = int(float(line.get('VPOS')) * coord_scale)
-        width = int(float(line.get('WIDTH')) * coord_scale)
-        height = int(float(line.get('HEIGHT')) * coord_scale)
-        line.set('HPOS', str(hpos))
-        line.set('VPOS', str(vpos))
-        line.set('WIDTH', str(width))
-        line.set('HEIGHT', str(height))
-        bl_x0, bl_y0, bl_x1, bl_y1 = _parse_alto_pointstype(line.get('BASELINE'))
-        line.set('BASELINE', f'{int(bl_x0 * coord_scale)},{int(bl_y0 * coord_scale)} {int(bl_x1 * coord_scale)},{int(bl_y1 * coord_scale)}')
-        pol = line.find('.//{*}Polygon')
-        pol.set('POINTS', f'{hpos},{vpos} {hpos+width},{vpos} {hpos+width},{vpos+height} {hpos},{vpos+height}')
-    tree.write(output_base_path / doc.name, encoding='utf-8')
+    # single pass over the document: the PDF page is rasterized as soon as
+    # the page element is encountered. The file name has been parsed from the
+    # description by then, and the page dimensions are known when the layout
+    # elements are rewritten.
+    context = etree.iterparse(source,
+                              events=('start', 'end'),
+                              tag=('{*}MeasurementUnit', '{*}fileName',
+                                   '{*}Page', '{*}PrintSpace', '{*}TextLine'))
+    lines = []
+    file_name = None
+    im_width = im_height = None
+    for event, elem in context:
+        tag = etree.QName(elem).localname
+        if event == 'start':
+            if tag == 'Page':
+                if file_name is None or not file_name.text:
+                    raise ValueError(f'{doc} has no sourceImageInformation/fileName before Page')
+                # files rendered with `single_pdf` contain all pages of a
+                # document, otherwise each file only contains a single page.
+                page_nr = int(elem.get('PHYSICAL_IMG_NR', 0))
+                png_name = doc.with_suffix('.png').name
+                im_width, im_height = _rasterize_page(pdf_file=doc.parent / file_name.text,
+                                                      page_nr=page_nr,
+                                                      output_path=output_base_path / png_name,
+                                                      writing_surface=writing_surface,
+                                                      dpi=dpi,
+                                                      compress_level=compress_level)
+                file_name.text = png_name
+            if tag in ('Page', 'PrintSpace'):
+                if im_width is None:
+                    raise ValueError(f'{doc} has PrintSpace outside of Page')
+                elem.set('WIDTH', str(im_width))
+                elem.set('HEIGHT', str(im_height))
+        elif tag == 'MeasurementUnit':
+            elem.text = 'pixel'
+        elif tag == 'fileName':
+            file_name = elem
+        elif tag == 'TextLine':
+            lines.append(elem)
+
+    # rewrite coordinates of all lines at once
+    if lines:
+        polygon_tag = etree.QName(etree.QName(context.root).namespace, 'Polygon').text
+        attribs = [line.attrib for line in lines]
+        boxes = np.fromiter((float(attrib[attr]) for attrib in attribs for attr in ('HPOS', 'VPOS', 'WIDTH', 'HEIGHT')),
+                            dtype=np.float64,
+                            count=4*len(lines)).reshape(-1, 4)
+        baselines = []
+        for attrib in attribs:
+            pts = _parse_alto_pointstype(attrib['BASELINE'])
+            if len(pts) != 4:
+                raise ValueError(f'Baseline is not a single line segment: {attrib["BASELINE"]}')
+            baselines.append(pts)
+        baselines = np.array(baselines, dtype=np.float64).reshape(-1, 4)
+        boxes = _mm_to_pixels(boxes, dpi).tolist()
+        baselines = _mm_to_pixels(baselines, dpi).tolist()
+        for line, attrib, (hpos, vpos, width, height), (bl_x0, bl_y0, bl_x1, bl_y1) in zip(lines, attribs, boxes, baselines):
+            x0, y0 = str(hpos), str(vpos)
+            x1, y1 = str(hpos + width), str(vpos + height)
+            attrib['HPOS'] = x0
+            attrib['VPOS'] = y0
+            attrib['WIDTH'] = str(width)
+            attrib['HEIGHT'] = str(height)
+            attrib['BASELINE'] = '%d,%d %d,%d' % (bl_x0, bl_y0, bl_x1, bl_y1)
+            pol = next(line.iter(polygon_tag))
+            pol.set('POINTS', '%s,%s %s,%s %s,%s %s,%s' % (x0, y0, x1, y0, x1, y1, x0, y1))
+    etree.ElementTree(context.root).write(output_base_path / doc.name, encoding='utf-8')
@@ -17,8 +17,8 @@ pangoline.render
 ~~~~~~~~~~~~~~~~
 """
 import gi
+import io
 import html
-import math
 import uuid
 import cairo
 import regex
@@ -30,11 +30,12 @@ gi.require_version('PangoCairo', '1.0')
 from gi.repository import Pango, PangoCairo
 
 from pathlib import Path
+from pangoline import alto
 from itertools import count
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union, Literal, Optional, TYPE_CHECKING, Sequence
 
-from jinja2 import Environment, PackageLoader
-
 if TYPE_CHECKING:
     from os import PathLike
 
@@ -85,6 +86,83 @@ _markup_colors = ['aliceblue', 'antiquewhite', 'aqua', 'aquamarine', 'azure',
                   'tomato', 'turquoise', 'violet', 'wheat', 'whitesmoke',
                   'yellow', 'yellowgreen']
 
+# base direction argument to Pango direction and ALTO BASE_DIRECTION value
+_pango_dir = {'R': Pango.Direction.RTL,
+              'L': Pango.Direction.LTR,
+              None: None}
+
+_alto_dir = {'R': 'rtl',
+             'L': 'ltr',
+             None: None}
+
+# splits text into word segments and everything in between. As the words
+# are captured they end up at the odd indices of the split.
+_word_split_re = regex.compile(r'(\m\w+\M)')
+
+
+def _build_marked_text(tokens: list[str],
+                       word_idxs: np.ndarray,
+                       selected: np.ndarray,
+                       colors: Optional[np.ndarray],
+                       markup_attrs: Sequence[tuple[str, str]]) -> str:
+    """
+    Wraps words in Pango markup spans and concatenates all tokens.
+
+    Args:
+        tokens: Escaped text segments. Modified in place.
+        word_idxs: Indices of the words in `tokens`.
+        selected: Boolean array of shape `(len(word_idxs), len(markup_attrs))`
+                  selecting the markup applied to each word.
+        colors: Index into `_markup_colors` for each word, used for
+                `foreground_random`. May be None if `foreground_random`
+                isn't enabled.
+        markup_attrs: `(attribute, value)` pair of each markup type.
+
+    Returns:
+        The marked up text.
+    """
+    for row in np.flatnonzero(selected.any(axis=1)):
+        ts = dict(markup_attrs[col] for col in np.flatnonzero(selected[row]))
+        if ts.get('foreground') == 'random':
+            ts['foreground'] = _markup_colors[colors[row]]
+        idx = word_idxs[row]
+        tokens[idx] = '<span ' + ' '.join(f'{k}="{v}"' for k, v in ts.items()) + f'>{tokens[idx]}</span>'
+    return ''.join(tokens)
+
+
+def _write_alto_file(path: Path, **kwargs):
+    """
+    Writes an ALTO file for a single page to `path`. See `alto.dump` for
+    the arguments.
+    """
+    # the buffer is large enough to hold most pages so the line chunks are
+    # written out in a single system call.
+    with open(path, 'wb', buffering=1 << 16) as fo:
+        alto.dump(fo, **kwargs)
+
+
+@lru_cache(maxsize=64)
+def _font_description(font: str) -> Pango.FontDescription:
+    """
+    Parses a font specification and enables ligatures on it.
+
+    Cached as a batch of documents is usually rendered in the same font.
+    """
+    font_desc = Pango.font_description_from_string(font)
+    font_desc.set_features('liga=1, clig=1, dlig=1, hlig=1')
+    return font_desc
+
+
+@lru_cache(maxsize=64)
+def _pango_language(language: Optional[str]) -> Pango.Language:
+    """
+    Looks up a Pango language by tag, falling back to the system default
+    language if no tag is given.
+    """
+    if language:
+        return Pango.language_from_string(language)
+    return Pango.language_get_default()
+
 
 def render_text(text: str,
                 output_base_path: Union[str, 'PathLike'],
@@ -114,7 +192,8 @@ def render_text(text: str,
                  'underline_double', 'overline_single', 'shift_subscript',
                  'shift_superscript', 'strikethrough_true'),
                 random_markup_probability: float = 0.0,
-                raise_unrenderable: bool = False):
+                raise_unrenderable: bool = False,
+                single_pdf: bool = False):
     """
     Renders (horizontal) text into a sequence of PDF files and creates parallel
     ALTO files for each page.
@@ -145,6 +224,10 @@ def render_text(text: str,
         raise_unrenderable: raises an exception if the supplied text contains
                             glyphs that are not contained in the selected
                             typeface.
+        single_pdf: Renders all pages into a single PDF file at
+                    `Path.with_suffix('.pdf')` instead of one file per page.
+                    The page index in the PDF is recorded in the
+                    `PHYSICAL_IMG_NR` attribute of each ALTO page.
 
     Raises:
         ValueError if the text contains unrenderable glyphs and
@@ -152,9 +235,6 @@ def render_text(text: str,
     """
     output_base_path = Path(output_base_path)
 
-    loader = PackageLoader('pangoline', 'templates')
-    tmpl = Environment(loader=loader).get_template('alto.tmpl')
-
     _mm_point = 72 / 25.4
     width, height = paper_size[0] * _mm_point, paper_size[1] * _mm_point
     top_margin = 25 * _mm_point
@@ -162,16 +242,11 @@ def render_text(text: str,
     left_margin = 20 * _mm_point
     right_margin = 20 * _mm_point
 
-    font_desc = Pango.font_description_from_string(font)
-    font_desc.set_features('liga=1, clig=1, dlig=1, hlig=1')
+    font_desc = _font_description(font)
     pango_text_width = Pango.units_from_double(width-(left_margin+right_margin))
-    if language:
-        pango_lang = Pango.language_from_string(language)
-    else:
-        pango_lang = Pango.language_get_default()
-    pango_dir = {'R': Pango.Direction.RTL,
-                 'L': Pango.Direction.LTR,
-                 None: None}[base_dir]
+    pango_lang = _pango_language(language)
+    pango_dir = _pango_dir[base_dir]
+    alto_dir = _alto_dir[base_dir]
 
     dummy_surface = cairo.PDFSurface(None, 1, 1)
     dummy_context = cairo.Context(dummy_surface)
@@ -201,19 +276,20 @@ def render_text(text: str,
         layout.set_attributes(attr)
     elif random_markup_probability > 0.0:
         rng = np.random.default_rng()
-        random_markup = np.array(random_markup)
-        marked_text = ''
-        for s in regex.splititer(r'(\m\w+\M)', text):
-            s = html.escape(s, quote=False)
-            # only mark up words, not punctuation, whitespace ...
-            if regex.match(r'\w+', s):
-                ts = random_markup[rng.random(len(random_markup)) > (1 - random_markup_probability) ** (1./len(random_markup))].tolist()
-                ts = {_markup_mapping[t.split('_', 1)[0]]: t.split('_', 1)[1] for t in ts}
-                if (color := ts.get('foreground')) and color == 'random':
-                    ts['foreground'] = rng.choice(_markup_colors)
-                if ts:
-                    s = '<span ' + ' '.join(f'{k}="{v}"' for k, v in ts.items()) + f'>{s}</span>'
-            marked_text += s
+        # (attribute, value) pairs of all enabled markup types
+        markup_attrs = [(_markup_mapping[t.split('_', 1)[0]], t.split('_', 1)[1]) for t in random_markup]
+        tokens = [html.escape(s, quote=False) for s in _word_split_re.split(text)]
+        # only mark up words, not punctuation, whitespace ...
+        word_idxs = np.arange(1, len(tokens), 2)
+        # draw all decisions at once. Each type is applied independently with
+        # a probability chosen such that at least one of them is applied to a
+        # word with probability `random_markup_probability`.
+        threshold = (1 - random_markup_probability) ** (1./len(markup_attrs))
+        selected = rng.random((len(word_idxs), len(markup_attrs))) > threshold
+        colors = None
+        if ('foreground', 'random') in markup_attrs:
+            colors = rng.integers(len(_markup_colors), size=len(word_idxs))
+        marked_text = _build_marked_text(tokens, word_idxs, selected, colors, markup_attrs)
         _, attr, text, _ = Pango.parse_markup(marked_text, -1, u'\x00')
         layout.set_text(text)
         layout.set_attributes(attr)
@@ -226,74 +302,156 @@ def render_text(text: str,
             raise ValueError(msg)
         logger.warning(msg)
 
-    utf8_text = text.encode('utf-8')
-
-    line_it = layout.get_iter()
+    # Pango indexes lines by byte offsets into the UTF-8 encoded text. Map
+    # each byte offset to a character offset by counting the bytes that
+    # start a code point, i.e. aren't continuation bytes (0b10xxxxxx).
+    utf8_text = np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+    byte_to_char = np.zeros(len(utf8_text) + 1, dtype=np.int64)
+    np.cumsum((utf8_text & 0xC0) != 0x80, out=byte_to_char[1:])
 
     page_print_space = Pango.units_from_double(height-(bottom_margin+top_margin))
-
-    for page_idx in count():
-        print_space_offset = page_idx * page_print_space
-
-        pdf_output_path = output_base_path.with_suffix(f'.{page_idx}.pdf')
-        alto_output_path = output_base_path.with_suffix(f'.{page_idx}.xml')
-
-        logger.info(f'Rendering {page_idx} to {pdf_output_path}')
-
-        line_splits = []
-
-        pdf_surface = cairo.PDFSurface(pdf_output_path, width, height)
+    # right edge of the print space RTL lines are aligned to
+    right_edge = width - right_margin
+
+    # collect the lines of the layout with their extents in a single pass and
+    # compute the coordinates of all of them at once.
+    lines = layout.get_lines_readonly()
+    line_spans = []
+    baselines = []
+    line_rtl = []
+    ink_extents = []
+    log_extents = []
+    line_it = layout.get_iter()
+    for line in lines:
+        baseline = line_it.get_baseline()
+        # integer overflow in baseline position
+        if baseline < 0:
+            logger.warning('Integer overflow in baseline position. Truncating text.')
+            break
+        ink, log = line.get_extents()
+        line_spans.append((line.start_index, line.length))
+        baselines.append(baseline)
+        line_rtl.append(line.get_resolved_direction() == Pango.Direction.RTL)
+        ink_extents.append((ink.x, ink.y, ink.width, ink.height))
+        log_extents.append((log.x, log.width))
+        line_it.next_line()
+
+    baselines = np.array(baselines, dtype=np.int64)
+    line_rtl = np.array(line_rtl, dtype=bool)
+    ink_extents = np.array(ink_extents, dtype=np.int64).reshape(-1, 4)
+    # round ink extents outwards to whole points like
+    # Pango.extents_to_pixels() does for inclusive rectangles.
+    ink_x = ink_extents[:, 0] // Pango.SCALE
+    ink_y = ink_extents[:, 1] // Pango.SCALE
+    ink_width = -(-(ink_extents[:, 0] + ink_extents[:, 2]) // Pango.SCALE) - ink_x
+    ink_height = -(-(ink_extents[:, 1] + ink_extents[:, 3]) // Pango.SCALE) - ink_y
+    log_x, log_width = np.array(log_extents, dtype=np.float64).reshape(-1, 2).T
+
+    # translate the byte offsets of all lines into character offsets at once.
+    # Lines without any ink, e.g. empty or whitespace-only ones, are skipped
+    # without looking at their text.
+    line_spans = np.array(line_spans, dtype=np.int64).reshape(-1, 2)
+    char_starts = byte_to_char[line_spans[:, 0]].tolist()
+    char_ends = byte_to_char[line_spans[:, 0] + line_spans[:, 1]].tolist()
+    line_texts = [text[start:end].strip() if has_ink else ''
+                  for start, end, has_ink in zip(char_starts, char_ends, (ink_extents[:, 2] > 0).tolist())]
+
+    # a line is placed on the page whose print space contains its baseline
+    page_idxs = (baselines - 1) // page_print_space
+    # baseline position relative to the print space
+    line_y = (baselines - page_idxs * page_print_space) / Pango.SCALE
+    bl = line_y + top_margin
+    top = bl + ink_y
+    bottom = top + ink_height
+    # line direction determines reference point of extents
+    ltr_left = ink_x + left_margin
+    rtl_right = right_edge - ink_x
+    left = np.where(line_rtl, rtl_right - ink_width, ltr_left)
+    right = np.where(line_rtl, rtl_right, ltr_left + ink_width)
+    draw_x = np.where(line_rtl,
+                      right_edge - (log_x + log_width) / Pango.SCALE,
+                      log_x / Pango.SCALE + left_margin) - left_margin
+
+    line_y = line_y.tolist()
+    draw_x = draw_x.tolist()
+    # boxes are rounded outwards, baselines to the nearest mm.
+    line_boxes = np.stack([left, top, right, bottom, bl], axis=1) / _mm_point
+    np.floor(line_boxes[:, :2], out=line_boxes[:, :2])
+    np.ceil(line_boxes[:, 2:4], out=line_boxes[:, 2:4])
+    np.round(line_boxes[:, 4], out=line_boxes[:, 4])
+    line_boxes = line_boxes.astype(np.int64)
+
+    # trailing pages without any text, e.g. from trailing line breaks, aren't
+    # written.
+    text_lines = np.flatnonzero(np.fromiter(map(bool, line_texts), dtype=bool, count=len(line_texts)))
+    if not len(text_lines):
+        logger.warning(f'No renderable text for output {output_base_path}')
+        return
+    num_pages = int(page_idxs[text_lines[-1]]) + 1
+    # lines of each page are a contiguous range as baselines are increasing
+    page_bounds = np.searchsorted(page_idxs, np.arange(num_pages + 1)).tolist()
+
+    lang_tag = pango_lang.to_string()
+
+    # IDs only need to be unique, so number lines and text blocks after a
+    # single random prefix instead of drawing a UUID for each of them.
+    id_prefix = f'_{uuid.uuid4().hex}'
+    line_nrs = count()
+
+    # PDFs are assembled in memory and written out in one go instead of
+    # through many small writes by cairo. In single PDF mode one surface
+    # keeps font subsets and other document-level state across pages.
+    if single_pdf:
+        pdf_output_path = output_base_path.with_suffix('.pdf')
+        pdf_buffer = io.BytesIO()
+        pdf_surface = cairo.PDFSurface(pdf_buffer, width, height)
         context = cairo.Context(pdf_surface)
         context.translate(left_margin, top_margin)
 
-        while not line_it.at_last_line():
-            line = line_it.get_line_readonly()
-            baseline = line_it.get_baseline()
-            # integer overflow in baseline position
-            if baseline < 0:
-                logger.warning('Integer overflow in baseline position. Aborting.')
-                return
-            if baseline > print_space_offset + page_print_space:
-                break
-            s_idx, e_idx = line.start_index, line.length
-            line_text = utf8_text[s_idx:s_idx+e_idx].decode('utf-8')
-            if line_text := line_text.strip():
-                # line direction determines reference point of extents
-                line_dir = line.get_resolved_direction()
-                ink_extents, log_extents = line.get_extents()
-                Pango.extents_to_pixels(ink_extents)
-                bl = Pango.units_to_double(baseline - print_space_offset) + top_margin
-                top = bl + ink_extents.y
-                bottom = top + ink_extents.height
-                if line_dir == Pango.Direction.RTL:
-                    right = (width - right_margin) - ink_extents.x
-                    left = right - ink_extents.width
-                    lleft = (width - right_margin) - Pango.units_to_double(log_extents.x + log_extents.width)
-                elif line_dir == Pango.Direction.LTR:
-                    left = ink_extents.x + left_margin
-                    lleft = Pango.units_to_double(log_extents.x) + left_margin
-                    right = left + ink_extents.width
-                line_splits.append({'id': f'_{uuid.uuid4()}',
-                                    'text': line_text,
-                                    'baseline': int(round(bl / _mm_point)),
-                                    'top': int(math.floor(top / _mm_point)),
-                                    'bottom': int(math.ceil(bottom / _mm_point)),
-                                    'left': int(math.floor(left / _mm_point)),
-                                    'right': int(math.ceil(right / _mm_point))})
-                context.move_to(lleft - left_margin, bl - top_margin)
-                PangoCairo.show_layout_line(context, line)
-            line_it.next_line()
-
-        # write ALTO XML file
-        with open(alto_output_path, 'w') as fo:
-            fo.write(tmpl.render(pdf_path=pdf_output_path.name,
-                                 language=pango_lang.to_string(),
-                                 base_dir={'L': 'ltr', 'R': 'rtl', None: None}[base_dir],
-                                 text_block_id=f'_{uuid.uuid4()}',
-                                 page_width=paper_size[0],
-                                 page_height=paper_size[1],
-                                 lines=line_splits))
-
-        pdf_surface.finish()
-        if line_it.at_last_line():
-            break
+    alto_writes = []
+    with ThreadPoolExecutor(max_workers=1) as alto_writer:
+        for page_idx in range(num_pages):
+            alto_output_path = output_base_path.with_suffix(f'.{page_idx}.xml')
+
+            if not single_pdf:
+                pdf_output_path = output_base_path.with_suffix(f'.{page_idx}.pdf')
+                pdf_buffer = io.BytesIO()
+                pdf_surface = cairo.PDFSurface(pdf_buffer, width, height)
+                context = cairo.Context(pdf_surface)
+                context.translate(left_margin, top_margin)
+
+            logger.info(f'Rendering {page_idx} to {pdf_output_path}')
+
+            page_lines = [idx for idx in range(page_bounds[page_idx], page_bounds[page_idx+1]) if line_texts[idx]]
+
+            # the ALTO file is written in the background while the page is drawn.
+            alto_writes.append(alto_writer.submit(_write_alto_file,
+                                                  alto_output_path,
+                                                  pdf_path=pdf_output_path.name,
+                                                  language=lang_tag,
+                                                  base_dir=alto_dir,
+                                                  text_block_id=f'{id_prefix}_block_{page_idx}',
+                                                  page_width=paper_size[0],
+                                                  page_height=paper_size[1],
+                                                  line_ids=[f'{id_prefix}_{next(line_nrs)}' for _ in page_lines],
+                                                  line_texts=[line_texts[idx] for idx in page_lines],
+                                                  line_boxes=line_boxes[page_lines],
+                                                  page_number=page_idx if single_pdf else 0))
+
+            for idx in page_lines:
+                context.move_to(draw_x[idx], line_y[idx])
+                PangoCairo.show_layout_line(context, lines[idx])
+
+            if single_pdf:
+                context.show_page()
+            else:
+                pdf_surface.finish()
+                pdf_output_path.write_bytes(pdf_buffer.getbuffer())
+
+        if single_pdf:
+            pdf_surface.finish()
+            pdf_output_path.write_bytes(pdf_buffer.getbuffer())
+
+    # raise any exception from writing the ALTO files
+    for alto_write in alto_writes:
+        alto_write.result()